@@ -2,29 +2,125 @@
 import sys
 
 import argparse
-import json
 import logging
 import os
+import random
 import re
+import orjson
+import pybreaker
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 from parser.snowflake_parser import parse_redshift_to_snowflake
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 MODE_HOST = "https://app.mode.com"
 
 REDSHIFT_DS_ID = 12345
 SNOWFLAKE_DS_ID = 12345
 
+# queries that prevent a report from being migrated, \s+ between words also matches newlines
+BANNED_QUERIES = ["create table", "insert into", "drop table"]
+BANNED_QUERIES_PATTERN = re.compile(
+    "|".join(banned_query.replace(" ", r"\s+") for banned_query in BANNED_QUERIES),
+    flags=re.IGNORECASE,
+)
+
+# quoted aliases, the alias itself is the middle group
+ALIASED_COLUMN_PATTERN = re.compile(
+    r"""(as\s+)("[^"]+"|'[^']+')([^\s]*?\s)""", flags=re.IGNORECASE
+)
+
+# query group statements, commented out in migrated queries
+QUERY_GROUP_PATTERN = re.compile(
+    r"^(set query_group to|reset query_group)", flags=re.MULTILINE
+)
+
+# etl tables that moved to the mode_etl schema in snowflake
+MODE_ETLS = [
+    "finance_customer_ops_and_fulfillment_costs",
+    "finance_daily_gmv_lfc",
+    "finance_daily_gmv_h2plan",
+    "finance_daily_gmv_projection",
+    "finance_interest_expense",
+    "finance_reserves",
+]
+MODE_ETLS_PATTERN = re.compile(rf" etl\.({'|'.join(MODE_ETLS)})\b", flags=re.IGNORECASE)
+
+# report run polling backs off exponentially, with jitter, between these bounds (in seconds)
+RUN_POLL_INITIAL_DELAY = 1.0
+RUN_POLL_MAX_DELAY = 15.0
+
+# long enough for Mode to answer a slow report clone with its own 503
+MODE_REQUEST_TIMEOUT = 120
+
+# queries are migrated concurrently, and each of them patches its attrs and charts concurrently
+# while its own thread fetches the charts, so each query can hold PATCH_WORKERS + 1 connections
+QUERY_WORKERS = 4
+PATCH_WORKERS = 8
+MODE_POOL_SIZE = QUERY_WORKERS * (PATCH_WORKERS + 1)
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 s = requests.Session()
 s.auth = HTTPBasicAuth(os.environ["MODE_API_TOKEN"], os.environ["MODE_API_PASSWORD"])
 s.headers.update({"Content-Type": "application/json", "Accept": "application/hal+json"})
+# retry transient gateway errors on idempotent calls only, POSTs such as cloning a report must not be
+# repeated. The last response is returned once retries run out so callers still see the HTTPError
+s.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=MODE_POOL_SIZE,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "PATCH"]),
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+def is_client_error(error):
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and error.response is not None
+        and error.response.status_code < 500
+    )
+
+
+# fail fast while Mode is down, only server errors, timeouts and connection errors count as failures.
+# The call that trips the breaker still raises its own error, e.g. the HTTPError with the 503
+MODE_BREAKER = pybreaker.CircuitBreaker(
+    fail_max=5,
+    reset_timeout=60,
+    exclude=[is_client_error],
+    throw_new_error_on_trip=False,
+)
+
+
+def wait_for_all(futures):
+    # re-raise the first exception raised by any of the futures
+    for future in as_completed(futures):
+        future.result()
+
+
+def send_request(method, request_args):
+    response = getattr(s, method)(**request_args)
+    # abort if there were any errors
+    response.raise_for_status()
+    return response
+
 
+send_mode_request = MODE_BREAKER(send_request)
 
-def mode_api(method, path, request_args=None):
+
+def mode_api(method, path, request_args=None, use_breaker=True):
     if request_args is None:
         request_args = {}
 
@@ -37,46 +133,44 @@ def mode_api(method, path, request_args=None):
         path = f"/api/<your-organization>{path}"
 
     request_args["url"] = f"{MODE_HOST}{path}"
+    request_args.setdefault("timeout", MODE_REQUEST_TIMEOUT)
+    # encode bodies with orjson, the Content-Type header is already set on the session
+    if "json" in request_args:
+        request_args["data"] = orjson.dumps(request_args.pop("json"))
     logger.info(f"Sending {method} to {path}")
-    response = getattr(s, method)(**request_args)
-    # abort if there were any errors
-    response.raise_for_status()
+    if use_breaker:
+        response = send_mode_request(method, request_args)
+    else:
+        response = send_request(method, request_args)
+    # some PATCH endpoints reply without a body
+    if not response.content:
+        return None
     # unwrap response if applicable
-    return response.json().get("_embedded", response.json())
-
-
-# recursively walk the provided view, trying to match the provided path
-# when we get to the end of the provided path, capitalize that element/list/dict
-def capitalize_view_field(view, *path):
-    if len(path) > 1:
-        if path[0] == "*":
-            # capitalize all list members
-            for item in view:
-                capitalize_view_field(item, *path[1:])
-        elif path[0] in view:
-            capitalize_view_field(view[path[0]], *path[1:])
-    elif path[0] in view:
-        if isinstance(view[path[0]], str):
-            view[path[0]] = view[path[0]].upper()
-        elif isinstance(view[path[0]], list):
-            view[path[0]] = [x.upper() for x in view[path[0]]]
-        elif isinstance(view[path[0]], dict):
-            view[path[0]] = {k.upper(): v for k, v in view[path[0]].items()}
-
-
-# try to capitalize a series of paths inside view/view_vegas if they exist
-def capitalize_view_fields(view):
-    capitalize_view_field(view, "area", "label")
-    capitalize_view_field(view, "area", "x")
-    capitalize_view_field(view, "area", "y")
-    capitalize_view_field(view, "bar", "x")
-    capitalize_view_field(view, "bar", "y")
-    capitalize_view_field(view, "bigNumber", "column")
-    capitalize_view_field(view, "bigNumber", "columns")
-    capitalize_view_field(view, "encoding", "column", "*", "formula")
-    capitalize_view_field(view, "encoding", "filter", "*", "formula")
-    capitalize_view_field(
-        view,
+    body = orjson.loads(response.content)
+    return body.get("_embedded", body)
+
+
+def capitalize_view_value(view, key):
+    if isinstance(view[key], str):
+        view[key] = view[key].upper()
+    elif isinstance(view[key], list):
+        view[key] = [x.upper() for x in view[key]]
+    elif isinstance(view[key], dict):
+        view[key] = {k.upper(): v for k, v in view[key].items()}
+
+
+# paths inside view/view_vegas to capitalize if they exist, "*" matches all list members
+CAPITALIZED_VIEW_PATHS = [
+    ("area", "label"),
+    ("area", "x"),
+    ("area", "y"),
+    ("bar", "x"),
+    ("bar", "y"),
+    ("bigNumber", "column"),
+    ("bigNumber", "columns"),
+    ("encoding", "column", "*", "formula"),
+    ("encoding", "filter", "*", "formula"),
+    (
         "encoding",
         "marks",
         "series",
@@ -86,52 +180,78 @@ def capitalize_view_fields(view):
         "values",
         "*",
         "formula",
-    )
+    ),
+    ("encoding", "marks", "properties", "angle", "values", "*", "formula"),
+    ("encoding", "marks", "properties", "color", "values", "*", "formula"),
+    ("encoding", "marks", "properties", "detail", "values", "*", "formula"),
+    ("encoding", "marks", "properties", "label", "values", "*", "formula"),
+    ("encoding", "marks", "properties", "size", "values", "*", "formula"),
+    ("encoding", "marks", "properties", "text", "values", "*", "formula"),
+    ("encoding", "marks", "properties", "tooltip", "values", "*", "formula"),
+    ("encoding", "sorts", "*", "source"),
+    ("encoding", "value", "*", "formula"),
+    ("encoding", "x", "*", "formula"),
+    ("encoding", "x2", "*", "formula"),
+    ("encoding", "y", "*", "formula"),
+    ("encoding", "y2", "*", "formula"),
+    ("fieldFormats",),
+    ("format", "flatTable", "columns", "*", "id"),
+    ("line", "label"),
+    ("line", "x"),
+    ("line", "y"),
+    ("linePlusBar", "label"),
+    ("linePlusBar", "x"),
+    ("linePlusBar", "y"),
+    ("linePlusBar", "ybars"),
+    ("linePlusBar", "ylines"),
+    ("pie", "label"),
+    ("pie", "value"),
+    ("pivotTable", "filterValues"),
+    ("scatter", "label"),
+    ("scatter", "x"),
+    ("scatter", "y"),
+]
+
+# marks the end of a path in a path trie
+PATH_END = None
+
+
+# merge paths into nested dicts keyed by path segment, so shared prefixes are only walked once
+def build_path_trie(paths):
+    trie = {}
+    for path in paths:
+        node = trie
+        for segment in path:
+            node = node.setdefault(segment, {})
+        node[PATH_END] = True
+    return trie
+
+
+CAPITALIZED_VIEW_TRIE = build_path_trie(CAPITALIZED_VIEW_PATHS)
+
+
+# walk the provided view and trie together, capitalizing the element/list/dict at the end of each
+# path
+def capitalize_view_trie(view, trie):
+    # (node, trie node) pairs still to visit
+    stack = [(view, trie)]
+    while stack:
+        node, trie_node = stack.pop()
+        for segment, children in trie_node.items():
+            if segment is PATH_END:
+                continue
+            if segment == "*":
+                # capitalize all list members
+                stack.extend((item, children) for item in node)
+            elif segment in node:
+                if PATH_END in children:
+                    capitalize_view_value(node, segment)
+                stack.append((node[segment], children))
 
-    capitalize_view_field(
-        view, "encoding", "marks", "properties", "angle", "values", "*", "formula"
-    )
-    capitalize_view_field(
-        view, "encoding", "marks", "properties", "color", "values", "*", "formula"
-    )
-    capitalize_view_field(
-        view, "encoding", "marks", "properties", "detail", "values", "*", "formula"
-    )
-    capitalize_view_field(
-        view, "encoding", "marks", "properties", "label", "values", "*", "formula"
-    )
-    capitalize_view_field(
-        view, "encoding", "marks", "properties", "size", "values", "*", "formula"
-    )
-    capitalize_view_field(
-        view, "encoding", "marks", "properties", "text", "values", "*", "formula"
-    )
-    capitalize_view_field(
-        view, "encoding", "marks", "properties", "tooltip", "values", "*", "formula"
-    )
 
-    capitalize_view_field(view, "encoding", "sorts", "*", "source")
-    capitalize_view_field(view, "encoding", "value", "*", "formula")
-    capitalize_view_field(view, "encoding", "x", "*", "formula")
-    capitalize_view_field(view, "encoding", "x2", "*", "formula")
-    capitalize_view_field(view, "encoding", "y", "*", "formula")
-    capitalize_view_field(view, "encoding", "y2", "*", "formula")
-    capitalize_view_field(view, "fieldFormats")
-    capitalize_view_field(view, "format", "flatTable", "columns", "*", "id")
-    capitalize_view_field(view, "line", "label")
-    capitalize_view_field(view, "line", "x")
-    capitalize_view_field(view, "line", "y")
-    capitalize_view_field(view, "linePlusBar", "label")
-    capitalize_view_field(view, "linePlusBar", "x")
-    capitalize_view_field(view, "linePlusBar", "y")
-    capitalize_view_field(view, "linePlusBar", "ybars")
-    capitalize_view_field(view, "linePlusBar", "ylines")
-    capitalize_view_field(view, "pie", "label")
-    capitalize_view_field(view, "pie", "value")
-    capitalize_view_field(view, "pivotTable", "filterValues")
-    capitalize_view_field(view, "scatter", "label")
-    capitalize_view_field(view, "scatter", "x")
-    capitalize_view_field(view, "scatter", "y")
+# try to capitalize a series of paths inside view/view_vegas if they exist
+def capitalize_view_fields(view):
+    capitalize_view_trie(view, CAPITALIZED_VIEW_TRIE)
     return view
 
 
@@ -139,20 +259,16 @@ def validate_report(report):
     logger.info(f'==== validating report {report["token"]}')
     report_queries = mode_api("get", f'/reports/{report["token"]}/queries')
 
-    banned_queries = ["create table", "insert into", "drop table"]
-
     has_redshift_queries = False
     for query in report_queries["queries"]:
         if query["data_source_id"] == REDSHIFT_DS_ID:
             has_redshift_queries = True
-            for banned_query in banned_queries:
-                if re.search(
-                    banned_query.replace(" ", r"\s+"),
-                    query["raw_query"].replace(r"\n", " "),
-                ):
-                    sys.exit(
-                        f"This report cannot be migrated because it uses a banned query '{banned_query}', please contact #snowflake-migration-mode for next steps."
-                    )
+            match = BANNED_QUERIES_PATTERN.search(query["raw_query"])
+            if match:
+                banned_query = " ".join(match.group(0).lower().split())
+                sys.exit(
+                    f"This report cannot be migrated because it uses a banned query '{banned_query}', please contact #snowflake-migration-mode for next steps."
+                )
 
     if not has_redshift_queries:
         sys.exit("This report does not use Redshift, so no migration is needed.")
@@ -171,9 +287,12 @@ def clone_report(report_token, prefix):
     cloned_report = None
     logger.info(f"==== cloning report {report_token}")
     try:
+        # a slow clone answers with a 503 although it succeeds, so it must not count towards
+        # tripping the breaker
         cloned_report = mode_api(
             original_report["_forms"]["clone"]["method"],
             original_report["_forms"]["clone"]["action"],
+            use_breaker=False,
         )
 
     except requests.exceptions.HTTPError as err:
@@ -254,35 +373,29 @@ def update_query_sql_syntax(raw_query):
         raw_query = "-- empty query"
 
     # find quoted aliased columns and uppercase all instances of them to match chart updates
-    aliased_columns = re.findall(
-        r"""(as\s+)("[^"]+"|'[^']+')([^\s]*?\s)""", raw_query, flags=re.IGNORECASE
-    )
-    for aliased_column in aliased_columns:
+    aliased_columns = {
         # match contains 3 groups, we want the middle one
-        column_id = aliased_column[1]
-        raw_query = raw_query.replace(column_id, column_id.upper())
+        aliased_column[1]
+        for aliased_column in ALIASED_COLUMN_PATTERN.findall(raw_query)
+    }
+    if aliased_columns:
+        # replace all of them in a single pass, longest first so that an alias containing
+        # another one is uppercased as a whole
+        aliased_columns_pattern = "|".join(
+            re.escape(column_id)
+            for column_id in sorted(aliased_columns, key=len, reverse=True)
+        )
+        raw_query = re.sub(
+            aliased_columns_pattern, lambda m: m.group(0).upper(), raw_query
+        )
 
     # query groups are not supported in snowflake, so comment them out
-    raw_query = re.sub(
-        r"^set query_group to", "-- set query_group to", raw_query, flags=re.MULTILINE
-    )
-    raw_query = re.sub(
-        r"^reset query_group", "-- reset query_group", raw_query, flags=re.MULTILINE
-    )
+    raw_query = QUERY_GROUP_PATTERN.sub(r"-- \1", raw_query)
 
     # migrate snowflake mode_etls
-    mode_etls = [
-        "finance_customer_ops_and_fulfillment_costs",
-        "finance_daily_gmv_lfc",
-        "finance_daily_gmv_h2plan",
-        "finance_daily_gmv_projection",
-        "finance_interest_expense",
-        "finance_reserves",
-    ]
-    for mode_etl in mode_etls:
-        raw_query = re.sub(
-            f" etl.{mode_etl}", f" mode_etl.{mode_etl}", raw_query, flags=re.IGNORECASE
-        )
+    raw_query = MODE_ETLS_PATTERN.sub(
+        lambda m: f" mode_etl.{m.group(1).lower()}", raw_query
+    )
 
     return parse_redshift_to_snowflake(raw_query)
 
@@ -310,40 +423,71 @@ def update_chart_capitalization(query):
     last_run_view_attrs = mode_api(
         "get", f'{last_run["_links"]["self"]["href"]}/view/attrs'
     )
-    for attr in last_run_view_attrs["attrs"]:
-        attr["formula_source"] = attr["formula_source"].upper()
-        attr["name"] = attr["name"].upper()
-        capitalized_attr = {"attr": attr}
-
-        mode_api(
-            "patch",
-            f'{last_run["_links"]["self"]["href"]}/view/attrs/{attr["token"]}',
-            {"json": capitalized_attr},
-        )
+    # attrs and charts are patched in one batch over the session's pooled connections, the charts
+    # are fetched while the attr patches are in flight
+    with ThreadPoolExecutor(max_workers=PATCH_WORKERS) as executor:
+        futures = []
+        for attr in last_run_view_attrs["attrs"]:
+            formula_source = attr["formula_source"].upper()
+            name = attr["name"].upper()
+            # nothing to patch if already capitalized, e.g. when re-running a migration
+            if formula_source == attr["formula_source"] and name == attr["name"]:
+                continue
+            attr["formula_source"] = formula_source
+            attr["name"] = name
+            capitalized_attr = {"attr": attr}
+
+            futures.append(
+                executor.submit(
+                    mode_api,
+                    "patch",
+                    f'{last_run["_links"]["self"]["href"]}/view/attrs/{attr["token"]}',
+                    {"json": capitalized_attr},
+                )
+            )
 
-    charts = mode_api("get", query["_links"]["charts"]["href"])
-    for chart in charts["charts"]:
-        snowflake_chart = {
-            "chart": {
-                "view": json.dumps(capitalize_view_fields(chart["view"])),
-                "view_vegas": json.dumps(capitalize_view_fields(chart["view_vegas"])),
-                "view_version": chart["view_version"],
-                "color_palette_token": chart["color_palette_token"],
+        charts = mode_api("get", query["_links"]["charts"]["href"])
+        for chart in charts["charts"]:
+            original_views = (
+                orjson.dumps(chart["view"]),
+                orjson.dumps(chart["view_vegas"]),
+            )
+            view, view_vegas = (
+                orjson.dumps(capitalize_view_fields(chart["view"])),
+                orjson.dumps(capitalize_view_fields(chart["view_vegas"])),
+            )
+            if (view, view_vegas) == original_views:
+                continue
+            snowflake_chart = {
+                "chart": {
+                    # Mode expects the views as JSON encoded strings
+                    "view": view.decode(),
+                    "view_vegas": view_vegas.decode(),
+                    "view_version": chart["view_version"],
+                    "color_palette_token": chart["color_palette_token"],
+                }
             }
-        }
 
-        mode_api(
-            chart["_forms"]["edit"]["method"],
-            chart["_forms"]["edit"]["action"],
-            {"json": snowflake_chart},
-        )
+            futures.append(
+                executor.submit(
+                    mode_api,
+                    chart["_forms"]["edit"]["method"],
+                    chart["_forms"]["edit"]["action"],
+                    {"json": snowflake_chart},
+                )
+            )
+        wait_for_all(futures)
 
 
 def update_filter_capitalization(report_token):
     report_filters = mode_api("get", f"/reports/{report_token}/filters")
     for report_filter in report_filters["report_filters"]:
-        report_filter["name"] = report_filter["name"].upper()
-        report_filter["formula"] = report_filter["formula"].upper()
+        name = report_filter["name"].upper()
+        formula = report_filter["formula"].upper()
+        if name == report_filter["name"] and formula == report_filter["formula"]:
+            continue
+        report_filter["name"] = name
+        report_filter["formula"] = formula
         capitalized_report_filter = {"report_filter": report_filter}
 
         mode_api(
@@ -353,20 +497,35 @@ def update_filter_capitalization(report_token):
         )
 
 
+def move_query_to_snowflake(query):
+    try:
+        update_chart_capitalization(query)
+    except pybreaker.CircuitBreakerError:
+        # Mode is down, not a report without charts
+        raise
+    except Exception as e:
+        logger.info(
+            "Cannot update chart capitalization, is there a table view in the report?"
+        )
+    update_datasource_and_sql_syntax(query)
+
+
 def move_to_snowflake(report_token):
     logger.info(f"==== moving {report_token} to snowflake")
     update_filter_capitalization(report_token)
 
     report_queries = mode_api("get", f"/reports/{report_token}/queries")
-    for query in report_queries["queries"]:
-        if query["data_source_id"] == REDSHIFT_DS_ID:
-            try:
-                update_chart_capitalization(query)
-            except Exception as e:
-                logger.info(
-                    "Cannot update chart capitalization, is there a table view in the report?"
-                )
-            update_datasource_and_sql_syntax(query)
+    # queries don't depend on each other, so migrate them concurrently
+    with ThreadPoolExecutor(max_workers=QUERY_WORKERS) as executor:
+        wait_for_all(
+            [
+                executor.submit(move_query_to_snowflake, query)
+                for query in report_queries["queries"]
+                if query["data_source_id"] == REDSHIFT_DS_ID
+            ]
+        )
+
+    logger.info(f"Parser cache: {parse_redshift_to_snowflake.cache_info()}")
 
 
 def run_report(report_token):
@@ -374,8 +533,10 @@ def run_report(report_token):
     run_report_response = mode_api("post", f"/reports/{report_token}/runs")
     logger.info("waiting for report run to finish...")
 
+    delay = RUN_POLL_INITIAL_DELAY
     while True:
-        time.sleep(10)
+        time.sleep(min(RUN_POLL_MAX_DELAY, delay))
+        delay = delay * 1.5 + random.uniform(0, 0.5)
         run = mode_api(
             "get", f"/reports/{report_token}/runs/{run_report_response['token']}"
         )
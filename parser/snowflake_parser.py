@@ -1,4 +1,5 @@
 import argparse
+import functools
 import logging.config
 import re
 
@@ -6,13 +7,191 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+# Patterns are compiled once at import time, grouped per parser, so that repeated calls to
+# parse_redshift_to_snowflake don't pay for re-parsing them on every query
+_ENCODING_PATTERNS = [
+    (re.compile(r"[\s]encode .*,", re.IGNORECASE), r","),
+    (re.compile(r"[\s]encode .*", re.IGNORECASE), r""),
+    (
+        re.compile(r"[\s]timestamp without time zone", re.IGNORECASE),
+        r" timestamp_ntz(9)",
+    ),
+]
+
+_DIST_SORT_PATTERNS = [
+    (re.compile(r"[\s]diststyle (all|even|auto|key)", re.IGNORECASE), r""),
+    (re.compile(r"distkey.*\)", re.IGNORECASE + re.MULTILINE + re.DOTALL), r""),
+    (re.compile(r"[\s]diststyle.*\)", re.IGNORECASE), r""),
+    (
+        re.compile(
+            r"((compound|interleaved) )?sortkey\s*\([^\(]*\)",
+            re.IGNORECASE + re.MULTILINE + re.DOTALL,
+        ),
+        r"",
+    ),
+    # sometimes distkey is defined in column attributes
+    (re.compile(r"distkey", re.IGNORECASE + re.MULTILINE + re.DOTALL), r""),
+]
+
+_BOOL_PATTERNS = [
+    (re.compile(r" bool[\s]*([,\n])", re.IGNORECASE), r" boolean\1"),
+    (re.compile(r"::[\s]*bool ", re.IGNORECASE), r":: boolean "),
+]
+
+_INT_PATTERNS = [
+    (
+        re.compile(r" (?:integer|int2|int4|int8|bigint|smallint)\b", re.IGNORECASE),
+        r" int",
+    ),
+]
+
+_VARCHAR_PATTERNS = [
+    (re.compile(r" varchar\([0-9]+\)", re.IGNORECASE), r" VARCHAR"),
+]
+
+_SEARCH_PATH_PATTERNS = [
+    (re.compile(r"set search_path to ", re.IGNORECASE), r"use schema "),
+]
+
+_ANALYZE_PATTERNS = [
+    (re.compile(r"analyze [\.\w\s]*;", re.IGNORECASE), r""),
+]
+
+_WLM_QUERY_SLOT_COUNT_PATTERNS = [
+    (re.compile(r"set wlm_query_slot_count to [\d]+;", re.IGNORECASE), r""),
+]
+
+_CTAS_PATTERNS = [
+    (
+        re.compile(
+            r"create table (.*) \([\s]*like[\s]*(.*)[\s]*\)",
+            re.IGNORECASE + re.MULTILINE,
+        ),
+        r"create table \1 like \2",
+    ),
+]
+
+_ATRT_PATTERNS = [
+    (
+        re.compile(
+            r"alter table (\w+)\.(\w+) rename to (\w+)", re.IGNORECASE + re.MULTILINE
+        ),
+        r"alter table \1.\2 rename to \1.\3",
+    ),
+]
+
+_CONVERT_TIMEZONE_UTC_PATTERNS = [
+    (
+        re.compile(r"convert_timezone\('utc'", re.IGNORECASE + re.MULTILINE),
+        r"convert_timezone('UTC'",
+    ),
+]
+
+_CONVERT_TIMEZONE_PACIFIC_PATTERNS = [
+    (
+        re.compile(r"convert_timezone\(('pst'|'pdt')", re.IGNORECASE + re.MULTILINE),
+        r"convert_timezone('America/Los_Angeles'",
+    ),
+]
+
+_CONVERT_DATE_TRUNC_WEEKS_PATTERNS = [
+    (
+        re.compile(r"date_trunc\('weeks'", re.IGNORECASE + re.MULTILINE),
+        r"date_trunc('week'",
+    ),
+]
+
+# Simple 1:1 swaps of method names. For example BOOL_OR() -> BOOLOR_AGG()
+_SWAPS = {
+    "BOOL_OR": "BOOLOR_AGG",
+    "BOOL_AND": "BOOLAND_AGG",
+    " ~ '": " regexp '",
+    "BTRIM": "TRIM",
+    "CHAR_LENGTH": "LEN",
+    "DATEPART": "DATE_PART",
+    # must come before DATE_DIFF so that it still matches when the swaps run in a single pass
+    r"(DATEDIFF|DATE_DIFF)\('weeks',": r"DATEDIFF('week', ",
+    "DATE_DIFF": "DATEDIFF",
+    r"DATE_ADD\(": "DATEADD(",
+    "FROM_UNIXTIME": "TO_TIMESTAMP",
+    r"JSON_EXTRACT_PATH_TEXT\(([\w\.]*), '(\w*)', true\)": r"\1:\2",
+    "IS FALSE": " = FALSE",
+    "IS TRUE": " = TRUE",
+    "NVL": "COALESCE",
+    "SYSDATE": "CURRENT_TIMESTAMP",
+    r"CEILING\(": "CEIL(",
+    r"ISNULL\(": "NVL(",
+}
+
+_SWAP_PATTERNS = [
+    (re.compile(orig, re.IGNORECASE), new) for orig, new in _SWAPS.items()
+]
+
+_TMP_PATTERNS = [
+    (
+        re.compile(r"production\.user_sessions_view", re.IGNORECASE),
+        r"production.user_sessions",
+    ),
+    (re.compile(r"rating__bigint", re.IGNORECASE), r"rating"),
+]
+
+# Token level rewrites that don't depend on multiline/dotall matching, in the order they used
+# to be applied as separate passes
+_TOKEN_PATTERNS = (
+    _BOOL_PATTERNS
+    + _INT_PATTERNS
+    + _VARCHAR_PATTERNS
+    + _SWAP_PATTERNS
+    + _SEARCH_PATH_PATTERNS
+    + _ANALYZE_PATTERNS
+    + _TMP_PATTERNS
+    + _WLM_QUERY_SLOT_COUNT_PATTERNS
+    + _CONVERT_TIMEZONE_UTC_PATTERNS
+    + _CONVERT_TIMEZONE_PACIFIC_PATTERNS
+    + _CONVERT_DATE_TRUNC_WEEKS_PATTERNS
+)
+
+_BACKREFERENCE = re.compile(r"\\(\d+)")
+
+
+def _fuse_patterns(patterns):
+    """Combine (pattern, replacement) pairs into a single alternation
+
+    Every pattern is wrapped in its own group, and numeric backreferences in its replacement are
+    shifted to point at the pattern's groups inside the fused regex. Returns the fused regex and
+    a mapping from the index of each wrapping group to its replacement template.
+    """
+    alternatives = []
+    replacements = {}
+    flags = 0
+    group_index = 1
+    for pattern, replace in patterns:
+        alternatives.append(f"({pattern.pattern})")
+        replacements[group_index] = _BACKREFERENCE.sub(
+            lambda m, offset=group_index: f"\\g<{offset + int(m.group(1))}>", replace
+        )
+        flags |= pattern.flags
+        group_index += pattern.groups + 1
+    return re.compile("|".join(alternatives), flags), replacements
+
+
+_FUSED_TOKEN_PATTERN, _FUSED_TOKEN_REPLACEMENTS = _fuse_patterns(_TOKEN_PATTERNS)
+
+
+# reports often repeat the same queries, so cache parsed results across calls
+@functools.lru_cache(maxsize=1024)
 def parse_redshift_to_snowflake(sql):
     if not sql:
         return sql
 
+    # none of the parsers introduce trigger substrings, so checking the input once is enough
+    lowered_sql = sql.lower()
     for parser in parsers:
         if not sql:
             return sql
+        triggers = parser_triggers.get(parser)
+        if triggers and not any(trigger in lowered_sql for trigger in triggers):
+            continue
         try:
             sql = parser(sql)
         except Exception as e:
@@ -23,78 +202,49 @@ def parse_redshift_to_snowflake(sql):
     return sql
 
 
-def parse_encoding(sql):
-    """Remove encodings from DDL statements"""
-    pattern = r"[\s]encode .*,"
-    replace = r","
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-
-    pattern = r"[\s]encode .*"
-    replace = r""
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-
-    pattern = r"[\s]timestamp without time zone"
-    replace = r" timestamp_ntz(9)"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-
+def _apply_patterns(patterns, sql):
+    for pattern, replace in patterns:
+        sql = pattern.sub(replace, sql)
     return sql
 
 
-def parse_dist_sort(sql):
-    """Remove diststyle and sortkeys from DDL statements"""
-    pattern = r"[\s]diststyle (all|even|auto|key)"
-    replace = r""
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
+def _apply_fused_pattern(pattern, replacements, sql):
+    # build the output in a single forward pass, copying the text between matches as is
+    parts = []
+    position = 0
+    for m in pattern.finditer(sql):
+        parts.append(sql[position : m.start()])
+        parts.append(m.expand(replacements[m.lastindex]))
+        position = m.end()
+    if not parts:
+        return sql
+    parts.append(sql[position:])
+    return "".join(parts)
 
-    pattern = r"distkey.*\)"
-    replace = r""
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE + re.MULTILINE + re.DOTALL)
 
-    pattern = r"[\s]diststyle.*\)"
-    replace = r""
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
+def parse_encoding(sql):
+    """Remove encodings from DDL statements"""
+    return _apply_patterns(_ENCODING_PATTERNS, sql)
 
-    pattern = r"((compound|interleaved) )?sortkey\s*\([^\(]*\)"
-    replace = r""
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE + re.MULTILINE + re.DOTALL)
 
-    # sometimes distkey is defined in column attributes
-    pattern = r"distkey"
-    replace = r""
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE + re.MULTILINE + re.DOTALL)
-    return sql
+def parse_dist_sort(sql):
+    """Remove diststyle and sortkeys from DDL statements"""
+    return _apply_patterns(_DIST_SORT_PATTERNS, sql)
 
 
 def parse_bool(sql):
     """Convert bool to boolean"""
-    pattern = r" bool[\s]*([,\n])"
-    replace = r" boolean\1"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-
-    pattern = r"::[\s]*bool "
-    replace = r":: boolean "
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-
-    return sql
+    return _apply_patterns(_BOOL_PATTERNS, sql)
 
 
 def parse_int(sql):
     """Convert int to snowflake data type"""
-    int_patterns = [r" integer", r" int2", r" int4", r" int8", r" bigint", r" smallint"]
-    for pattern in int_patterns:
-        replace = r" int"
-        sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-
-    return sql
+    return _apply_patterns(_INT_PATTERNS, sql)
 
 
 def parse_varchar(sql):
     """Convert int to snowflake data type"""
-    pattern = r" varchar\([0-9]+\)"
-    replace = r" VARCHAR"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-
-    return sql
+    return _apply_patterns(_VARCHAR_PATTERNS, sql)
 
 
 def parse_trailing_whitespace(sql):
@@ -104,128 +254,75 @@ def parse_trailing_whitespace(sql):
 
 def parse_search_path(sql):
     """Convert set search_path"""
-    pattern = r"set search_path to "
-    replace = r"use schema "
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-    return sql
+    return _apply_patterns(_SEARCH_PATH_PATTERNS, sql)
 
 
 def parse_analyze(sql):
     """Remove all analyze statements"""
-    pattern = r"analyze [\.\w\s]*;"
-    replace = r""
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-    return sql
+    return _apply_patterns(_ANALYZE_PATTERNS, sql)
 
 
 def parse_wlm_query_slot_count(sql):
-    pattern = r"set wlm_query_slot_count to [\d]+;"
-    replace = r""
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-    return sql
+    return _apply_patterns(_WLM_QUERY_SLOT_COUNT_PATTERNS, sql)
 
 
 def parse_ctas(sql):
     """Convert create table as statements"""
-    pattern = r"create table (.*) \([\s]*like[\s]*(.*)[\s]*\)"
-    replace = r"create table \1 like \2"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE + re.MULTILINE)
-    return sql
+    return _apply_patterns(_CTAS_PATTERNS, sql)
 
 
 def parse_atrt(sql):
     """Convert alter table rename to statements"""
-
-    pattern = r"alter table (\w+)\.(\w+) rename to (\w+)"
-    replace = r"alter table \1.\2 rename to \1.\3"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE + re.MULTILINE)
-    return sql
+    return _apply_patterns(_ATRT_PATTERNS, sql)
 
 
 def parse_convert_timezone_utc(sql):
     """Convert utc time zone"""
-
-    pattern = r"convert_timezone\('utc'"
-    replace = r"convert_timezone('UTC'"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE + re.MULTILINE)
-    return sql
+    return _apply_patterns(_CONVERT_TIMEZONE_UTC_PATTERNS, sql)
 
 
 def parse_convert_timezone_pacific(sql):
     """Convert pacific time zones"""
-
-    pattern = r"convert_timezone\(('pst'|'pdt')"
-    replace = r"convert_timezone('America/Los_Angeles'"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE + re.MULTILINE)
-    return sql
+    return _apply_patterns(_CONVERT_TIMEZONE_PACIFIC_PATTERNS, sql)
 
 
 def parse_convert_date_trunc_weeks(sql):
     """Convert date_trunc with weeks"""
-
-    pattern = r"date_trunc\('weeks'"
-    replace = r"date_trunc('week'"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE + re.MULTILINE)
-    return sql
+    return _apply_patterns(_CONVERT_DATE_TRUNC_WEEKS_PATTERNS, sql)
 
 
 def parse_swap_methods(sql):
     """Simple 1:1 swaps of method names. For example BOOL_OR() -> BOOLOR_AGG()"""
-    swaps = {
-        "BOOL_OR": "BOOLOR_AGG",
-        "BOOL_AND": "BOOLAND_AGG",
-        " ~ '": " regexp '",
-        "BTRIM": "TRIM",
-        "CHAR_LENGTH": "LEN",
-        "DATEPART": "DATE_PART",
-        "DATE_DIFF": "DATEDIFF",
-        "DATE_ADD\(": "DATEADD(",
-        "(DATEDIFF|DATE_DIFF)(\('weeks',)(.*)": r"DATEDIFF('week', \3",
-        "FROM_UNIXTIME": "TO_TIMESTAMP",
-        r"JSON_EXTRACT_PATH_TEXT\(([\w\.]*), '(\w*)', true\)": r"\1:\2",
-        "IS FALSE": " = FALSE",
-        "IS TRUE": " = TRUE",
-        "NVL": "COALESCE",
-        "SYSDATE": "CURRENT_TIMESTAMP",
-        "CEILING\(": "CEIL(",
-        "ISNULL\(": "NVL(",
-    }
-    for orig, new in swaps.items():
-        sql = re.sub(orig, new, sql, flags=re.IGNORECASE)
-    return sql
+    return _apply_patterns(_SWAP_PATTERNS, sql)
 
 
 def parse_tmp(sql):
     """Convert tmp stuff"""
-    pattern = r"production\.user_sessions_view"
-    replace = r"production.user_sessions"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
+    return _apply_patterns(_TMP_PATTERNS, sql)
 
-    pattern = r"rating__bigint"
-    replace = r"rating"
-    sql = re.sub(pattern, replace, sql, flags=re.IGNORECASE)
-    return sql
+
+def parse_tokens(sql):
+    """Apply all token level rewrites in a single pass over the sql"""
+    return _apply_fused_pattern(_FUSED_TOKEN_PATTERN, _FUSED_TOKEN_REPLACEMENTS, sql)
 
 
 parsers = [
     parse_encoding,
     parse_dist_sort,
-    parse_bool,
-    parse_int,
-    parse_varchar,
+    parse_tokens,
     parse_trailing_whitespace,
-    parse_swap_methods,
-    parse_search_path,
-    parse_analyze,
     parse_ctas,
     parse_atrt,
-    parse_tmp,
-    parse_wlm_query_slot_count,
-    parse_convert_timezone_utc,
-    parse_convert_timezone_pacific,
-    parse_convert_date_trunc_weeks,
 ]
 
+# lowercase substrings that must appear in the sql for a parser to have anything to rewrite
+parser_triggers = {
+    parse_encoding: ("encode", "timestamp without time zone"),
+    parse_dist_sort: ("diststyle", "distkey", "sortkey"),
+    parse_ctas: ("create table",),
+    parse_atrt: ("alter table",),
+}
+
 
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser()
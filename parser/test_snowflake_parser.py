@@ -0,0 +1,86 @@
+from parser import snowflake_parser as sp
+
+# the pattern groups in the order they were applied before the token rewrites were fused
+_SEQUENTIAL_PASSES = [
+    sp._ENCODING_PATTERNS,
+    sp._DIST_SORT_PATTERNS,
+    sp._BOOL_PATTERNS,
+    sp._INT_PATTERNS,
+    sp._VARCHAR_PATTERNS,
+    None,  # trailing whitespace
+    sp._SWAP_PATTERNS,
+    sp._SEARCH_PATH_PATTERNS,
+    sp._ANALYZE_PATTERNS,
+    sp._CTAS_PATTERNS,
+    sp._ATRT_PATTERNS,
+    sp._TMP_PATTERNS,
+    sp._WLM_QUERY_SLOT_COUNT_PATTERNS,
+    sp._CONVERT_TIMEZONE_UTC_PATTERNS,
+    sp._CONVERT_TIMEZONE_PACIFIC_PATTERNS,
+    sp._CONVERT_DATE_TRUNC_WEEKS_PATTERNS,
+]
+
+SQLS = [
+    """CREATE TABLE IF NOT EXISTS etl.foo
+(
+	id BIGINT NOT NULL  ENCODE az64,
+	name VARCHAR(256)   ENCODE lzo,
+	flag bool,
+	cnt integer ENCODE az64,
+	small smallint,
+	i2 int2, i4 int4, i8 int8,
+	ts timestamp without time zone ENCODE az64
+)
+DISTSTYLE KEY
+ DISTKEY (id)
+ SORTKEY (
+	ts
+	)
+;""",
+    """set search_path to etl;
+set wlm_query_slot_count to 3;
+select bool_or(x), bool_and(y), btrim(z), char_length(a), datepart(day, b), date_diff('day', a, b),
+ date_add('day', 1, c), datediff('weeks', a, b), from_unixtime(t), json_extract_path_text(j.k, 'foo', true),
+ x is false, y IS TRUE, nvl(a,b), sysdate, ceiling(x), isnull(y, 0), z ~ 'abc', y::bool , convert_timezone('utc', 'pst', t),
+ convert_timezone('pdt', t), date_trunc('weeks', t), rating__bigint
+from production.user_sessions_view;
+analyze etl.foo;
+create table a.b ( like a.c );
+alter table etl.foo rename to bar;
+
+""",
+    "select 1",
+    "",
+    "select date_diff('weeks', a, b) as \"Foo Bar\" from etl.finance_reserves  \n",
+    "select nvl(json_extract_path_text(j, 'k'), 'x'), isnull(a, b) from t",
+]
+
+
+def parse_sequentially(sql):
+    for patterns in _SEQUENTIAL_PASSES:
+        if not sql:
+            return sql
+        if patterns is None:
+            sql = sp.parse_trailing_whitespace(sql)
+        else:
+            sql = sp._apply_patterns(patterns, sql)
+    return sql
+
+
+def test_fused_matches_sequential():
+    for sql in SQLS:
+        assert sp.parse_redshift_to_snowflake(sql) == parse_sequentially(sql), sql
+
+
+def test_trailing_whitespace_stripped_after_rewrites():
+    # whitespace left behind by a removed trailing statement used to be kept
+    sql = "select 1;\nanalyze foo;\n"
+    assert parse_sequentially(sql) == "select 1;\n"
+    assert sp.parse_redshift_to_snowflake(sql) == "select 1;"
+
+
+def test_rewritten_text_is_not_rescanned():
+    # a later swap used to match inside the output of an earlier one
+    sql = "select json_extract_path_text(t.nvl, 'k', true)"
+    assert parse_sequentially(sql) == "select t.COALESCE:k"
+    assert sp.parse_redshift_to_snowflake(sql) == "select t.nvl:k"
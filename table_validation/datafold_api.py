@@ -1,8 +1,12 @@
+import asyncio
 import logging
+import random
 import time
 from pprint import pformat
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, List, Tuple, Union
 
+import aiohttp
+import pybreaker
 import requests
 
 log = logging.getLogger()
@@ -12,6 +16,15 @@ class DatafoldApiError(Exception):
     pass
 
 
+# Stops polling a Datafold outage forever: after 5 consecutive server errors, timeouts or connection
+# errors every call fails immediately for a minute, then a single call is let through as a probe.
+# Client errors are returned to the caller rather than raised, so they never count. The call that
+# trips the breaker still raises its own error
+DATAFOLD_BREAKER = pybreaker.CircuitBreaker(
+    fail_max=5, reset_timeout=60, throw_new_error_on_trip=False
+)
+
+
 class DatafoldApi(object):
 
     DATADIFF_REQUEST_FIELDS = [
@@ -34,6 +47,20 @@ class DatafoldApi(object):
         "diff_tolerance_per_column",  # Optional[List[dict]] = None
     ]
 
+    # polling backs off exponentially, with jitter, between these bounds (in seconds)
+    POLL_INITIAL_DELAY = 1.0
+    POLL_MAX_DELAY = 15.0
+
+    # seconds to wait for any single api response
+    REQUEST_TIMEOUT = 60
+
+    # connections shared by all diffs polled concurrently by run_diffs
+    MAX_CONNECTIONS = 16
+
+    # consecutive server errors, timeouts or connection errors tolerated on a single run_diffs
+    # poll, pybreaker can't wrap coroutines so this bounds retries during an outage instead
+    MAX_SERVER_ERRORS = 5
+
     def __init__(
         self,
         *,
@@ -54,6 +81,10 @@ class DatafoldApi(object):
         self.datafold_datasource_id = int(datafold_datasource_id)
         self.base_url = base_url
 
+        # reuse connections between the submit and polling requests
+        self._session = requests.Session()
+        self._session.headers["Authorization"] = "Key " + api_key
+
     def run_diff(
         self,
         table1,
@@ -67,6 +98,102 @@ class DatafoldApi(object):
         sampling_confidence,
         diff_tolerances_per_column,
     ):
+        req = self._build_request(
+            table1,
+            table2,
+            query1,
+            query2,
+            pks,
+            exclude_columns,
+            filter,
+            sampling_tolerance,
+            sampling_confidence,
+            diff_tolerances_per_column,
+        )
+
+        url, res = self._run_diff(self.base_url, req)
+
+        log.info("Datafold url: %s", url)
+        log.info("Datafold result: %s", pformat(res))
+
+        return url, res
+
+    def run_diffs(
+        self, diffs: List[Dict[str, Any]]
+    ) -> List[Union[Tuple[str, Any], BaseException]]:
+        """Run several diffs concurrently, polling all of them from a single event loop
+
+        A diff that fails doesn't stop the others, its exception is returned in its place.
+
+        Args:
+            diffs: list of keyword arguments for run_diff
+
+        Returns:
+            List of datafold result url and result payload tuples, or the exception raised by
+            the diff, in the order of diffs
+        """
+        return asyncio.run(self._run_diffs(diffs))
+
+    async def _run_diffs(
+        self, diffs: List[Dict[str, Any]]
+    ) -> List[Union[Tuple[str, Any], BaseException]]:
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.MAX_CONNECTIONS),
+            headers={"Authorization": "Key " + self.api_key},
+            timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT),
+        ) as session:
+            return await asyncio.gather(
+                *[self.run_diff_async(session, **diff) for diff in diffs],
+                return_exceptions=True,
+            )
+
+    async def run_diff_async(
+        self,
+        session: aiohttp.ClientSession,
+        table1,
+        table2,
+        query1,
+        query2,
+        pks,
+        exclude_columns,
+        filter,
+        sampling_tolerance,
+        sampling_confidence,
+        diff_tolerances_per_column,
+    ):
+        req = self._build_request(
+            table1,
+            table2,
+            query1,
+            query2,
+            pks,
+            exclude_columns,
+            filter,
+            sampling_tolerance,
+            sampling_confidence,
+            diff_tolerances_per_column,
+        )
+
+        url, res = await self._run_diff_async(session, self.base_url, req)
+
+        log.info("Datafold url: %s", url)
+        log.info("Datafold result: %s", pformat(res))
+
+        return url, res
+
+    def _build_request(
+        self,
+        table1,
+        table2,
+        query1,
+        query2,
+        pks,
+        exclude_columns,
+        filter,
+        sampling_tolerance,
+        sampling_confidence,
+        diff_tolerances_per_column,
+    ) -> Dict[str, Any]:
         if not (all((table1, table2)) or all((query1, query2))):
             raise DatafoldApiError(
                 "Failed to submit diff. You need to provide either tables or query to run the diff on"
@@ -100,19 +227,40 @@ class DatafoldApi(object):
         # Update req with keys that point to the data source. Table vs. query
         req.update(comparison_keys)
 
-        url, res = self._run_diff(self.base_url, self.api_key, req)
+        return req
 
-        log.info("Datafold url: %s", url)
-        log.info("Datafold result: %s", pformat(res))
+    def _build_payload(self, req: Dict[str, Any]) -> Dict[str, Any]:
+        payload = {f: None for f in self.DATADIFF_REQUEST_FIELDS}
+        payload.update(req)
+        log.info("Request payload: %s", payload)
+        return payload
 
-        return url, res
+    @DATAFOLD_BREAKER
+    def _request(self, method, url, **kwargs) -> requests.Response:
+        response = self._session.request(
+            method, url, timeout=self.REQUEST_TIMEOUT, **kwargs
+        )
+        # only server errors are raised here, callers handle the other responses
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _is_done(task: Dict[str, Any]) -> bool:
+        subtasks_done = all(
+            status in ("done", "failed") for status in task["result_statuses"].values()
+        )
+        return task["done"] is True and subtasks_done
+
+    @staticmethod
+    def _next_poll_delay(delay: float) -> float:
+        return delay * 1.5 + random.uniform(0, 0.5)
 
-    def _run_diff(self, base_url, api_key: str, req: Dict[str, Any]) -> Tuple[str, Any]:
+    def _run_diff(self, base_url, req: Dict[str, Any]) -> Tuple[str, Any]:
         """Implementation borrowed from datafold
 
         Args:
             base_url: base url for the api call
-            api_key: api key
             req: req object
 
         Returns:
@@ -121,39 +269,119 @@ class DatafoldApi(object):
 
         base_api_url = base_url + "/api/datadiffs"
 
-        payload = {f: None for f in self.DATADIFF_REQUEST_FIELDS}
-        payload.update(req)
-        log.info("Request payload: %s", payload)
-        headers = {"Authorization": "Key " + api_key}
-        r = requests.post(url=base_api_url, json=payload, headers=headers)
+        payload = self._build_payload(req)
+        r = self._request("post", base_api_url, json=payload)
         if r.status_code != 200:
             raise DatafoldApiError("Failed to submit diff: {}".format(r.text))
         response = r.json()
         log.info(response)
 
         job_id = response["id"]
+        delay = self.POLL_INITIAL_DELAY
         while True:
-            job = requests.get(
-                url="{}/{}?poll".format(base_api_url, job_id), headers=headers
-            )
+            job = self._request("get", "{}/{}?poll".format(base_api_url, job_id))
 
             log.info("Polling job result received: %s", job)
 
             task = job.json()
-            subtasks_done = all(
-                status in ("done", "failed")
-                for status in task["result_statuses"].values()
-            )
-            if task["done"] is True and subtasks_done:
+            if self._is_done(task):
                 log.info("Diff done!")
                 break
 
-            time.sleep(3)
+            time.sleep(min(self.POLL_MAX_DELAY, delay))
+            delay = self._next_poll_delay(delay)
 
-        results_reply = requests.get(
-            url="{}/{}/results_summary".format(base_api_url, job_id), headers=headers
+        results_reply = self._request(
+            "get", "{}/{}/results_summary".format(base_api_url, job_id)
         )
         results = results_reply.json()
 
         ui_url = base_url + "/datadiffs/" + str(task["id"])
         return ui_url, results
+
+    async def _run_diff_async(
+        self, session: aiohttp.ClientSession, base_url, req: Dict[str, Any]
+    ) -> Tuple[str, Any]:
+        """Same as _run_diff, but waits on the event loop instead of blocking
+
+        Args:
+            session: aiohttp session carrying the api key
+            base_url: base url for the api call
+            req: req object
+
+        Returns:
+            Tuple of datafold result url and the result payload
+        """
+
+        base_api_url = base_url + "/api/datadiffs"
+
+        payload = self._build_payload(req)
+        async with session.post(base_api_url, json=payload) as r:
+            if r.status != 200:
+                raise DatafoldApiError(
+                    "Failed to submit diff: {}".format(await r.text())
+                )
+            response = await r.json(content_type=None)
+        log.info(response)
+
+        job_id = response["id"]
+        delay = self.POLL_INITIAL_DELAY
+        while True:
+            task = await self._get_async(
+                session, "{}/{}?poll".format(base_api_url, job_id)
+            )
+
+            log.info("Polling job result received: %s", task)
+
+            if self._is_done(task):
+                log.info("Diff %s done!", job_id)
+                break
+
+            await asyncio.sleep(min(self.POLL_MAX_DELAY, delay))
+            delay = self._next_poll_delay(delay)
+
+        results = await self._get_async(
+            session, "{}/{}/results_summary".format(base_api_url, job_id)
+        )
+
+        ui_url = base_url + "/datadiffs/" + str(task["id"])
+        return ui_url, results
+
+    async def _get_async(self, session: aiohttp.ClientSession, url) -> Any:
+        """Get a json payload, retrying server errors with the polling backoff
+
+        Args:
+            session: aiohttp session carrying the api key
+            url: url to get
+
+        Returns:
+            The decoded json payload
+        """
+        delay = self.POLL_INITIAL_DELAY
+        for attempt in range(1, self.MAX_SERVER_ERRORS + 1):
+            try:
+                async with session.get(url) as r:
+                    if r.status < 500:
+                        if r.status != 200:
+                            raise DatafoldApiError(
+                                "Failed to poll diff: {}".format(await r.text())
+                            )
+                        return await r.json(content_type=None)
+                    error = "status {}".format(r.status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            log.warning(
+                "Datafold request %s failed (%s/%s): %s",
+                url,
+                attempt,
+                self.MAX_SERVER_ERRORS,
+                error,
+            )
+            if attempt < self.MAX_SERVER_ERRORS:
+                await asyncio.sleep(min(self.POLL_MAX_DELAY, delay))
+                delay = self._next_poll_delay(delay)
+        raise DatafoldApiError(
+            "Failed to poll diff after {} attempts: {}".format(
+                self.MAX_SERVER_ERRORS, error
+            )
+        )
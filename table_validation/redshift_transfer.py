@@ -1,35 +1,129 @@
+import itertools
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
-import sqlparse
 from faire.internal.snowflake_client import client as snowflake_client
 from faire.internal.vendor.aws import redshift
 
+try:
+    from table_validation.sql_identifiers import validate_identifiers
+    from table_validation.sql_logging import log_sql
+except ModuleNotFoundError:
+    from sql_identifiers import validate_identifiers
+    from sql_logging import log_sql
+
 log = logging.getLogger()
 
 special_chars = re.compile(r"[^a-zA-Z_\s\d,\"\(\)]")
+# ascii characters allowed by special_chars, so ascii lines can be checked with bytes.translate
+allowed_ascii_chars = bytes(c for c in range(128) if not special_chars.match(chr(c)))
+quotes = str.maketrans("", "", "\"'")
 
 S3_BUCKET = "YOUR_BUCKET"
 IAM_ROLE = "IAM_ROLE"
 SNOWFLAKE_STAGE = "SNOWFLAKE_STAGE"
 
+# parquet is typed and columnar so neither side has to serialize or tokenize text,
+# csv is kept as a fallback for column types parquet unloads don't support
+UNLOAD_FORMATS = ("parquet", "csv")
+
+# table_definition rows fetched per round trip while parsing the ddl
+DDL_FETCH_SIZE = 1000
+
+DDL_SQL = """
+select * from table_definition where schemaname = '{schema}'
+and tablename = '{table}';
+"""
+
+UNLOAD_SQL = """
+unload ($$select * from {schema}.{table}
+where {column} <= {watermark}$$)
+to 's3://{s3_bucket}/unload/snowflake_parity/nsp={schema}/{table}/{bucket}/'
+iam_role '{iam_role}'
+{format_options}
+cleanpath;
+"""
+
+UNLOAD_PARQUET_OPTIONS = """
+format as parquet
+maxfilesize 256MB
+"""
+
+UNLOAD_CSV_OPTIONS = """
+delimiter '|'
+addquotes
+null 'NULL'
+escape
+maxfilesize 100MB
+gzip
+"""
+
+UNLOAD_UNQUOTED_CSV_OPTIONS = """
+delimiter '|'
+null 'NULL'
+maxfilesize 100MB
+gzip
+"""
+
+COPY_SQL = """
+copy into {landing_table}
+from
+@{stage}/unload/snowflake_parity/nsp={schema}/{table}/{bucket}/
+{format_options};
+"""
+
+# parquet columns are matched to the landing table by name instead of position
+COPY_PARQUET_OPTIONS = """
+file_format = (type = parquet)
+match_by_column_name = case_insensitive
+"""
+
+COPY_CSV_OPTIONS = r"""
+file_format = (
+type = csv
+compression = gzip
+field_delimiter = '|'
+field_optionally_enclosed_by = '"'
+escape = '\\'
+null_if = ('NULL')
+empty_field_as_null = False
+)
+"""
+
+COPY_UNQUOTED_CSV_OPTIONS = """
+file_format = (
+type = csv
+compression = gzip
+field_delimiter = '|'
+null_if = ('NULL')
+empty_field_as_null = False
+)
+"""
+
 
 def contains_special_chars(line):
+    if line.isascii():
+        # anything left after deleting the allowed characters is special
+        return bool(line.encode("ascii").translate(None, allowed_ascii_chars))
     return bool(special_chars.search(line))
 
 
-def standardize_columns(line, remove_quotes_from_create_table):
+def can_remove_quotes(line, remove_quotes_from_create_table):
 
     if remove_quotes_from_create_table and "CREATE TABLE IF NOT EXISTS" in line:
-        return line.replace('"', "").replace("'", "")
+        return True
 
     # if a line contains these special characters, columns should be kept enclosed with quotes
-    if contains_special_chars(line):
-        return line
-    else:
-        return line.replace('"', "").replace(
-            "'", ""
-        )  # quotes around column names force lowercase in snowflake
+    return not contains_special_chars(line)
+
+
+def standardize_columns(line, remove_quotes_from_create_table):
+    if can_remove_quotes(line, remove_quotes_from_create_table):
+        # quotes around column names force lowercase in snowflake
+        return line.translate(quotes)
+    return line
 
 
 class RedshiftToSnowflakeTransfer(object):
@@ -43,8 +137,17 @@ class RedshiftToSnowflakeTransfer(object):
         remove_quotes_from_create_table,
         watermark_column=None,
         high_watermark=None,
+        unload_format="parquet",
+        strict_quotes=True,
         **_,
     ):
+        validate_identifiers(
+            redshift_src_schema=redshift_src_schema,
+            redshift_src_table=redshift_src_table,
+            snowflake_dest_db=snowflake_dest_db,
+            snowflake_dest_schema=snowflake_dest_schema,
+            watermark_column=watermark_column,
+        )
         self.r_src_schema = redshift_src_schema.lower()
         self.r_src_table = redshift_src_table.lower()
         self.s_dest_db = snowflake_dest_db
@@ -52,39 +155,82 @@ class RedshiftToSnowflakeTransfer(object):
         self.remove_quotes_from_create_table = remove_quotes_from_create_table
         self.watermark_column = watermark_column
         self.watermark = high_watermark.strftime("%Y-%m-%d") if high_watermark else None
+        if unload_format not in UNLOAD_FORMATS:
+            raise Exception(
+                f"unload_format must be one of {UNLOAD_FORMATS}, got {unload_format}"
+            )
+        self.unload_format = unload_format
+        # csv cells are quoted and escaped unless the table is known not to contain delimiters,
+        # quotes or newlines, which spares both sides from scanning every cell for them
+        self.strict_quotes = strict_quotes
 
         self.s_landing_table = f"{self.s_dest_db}.{self.s_dest_schema}.redshift_{self.r_src_schema}_{self.r_src_table}"
         log.info("Redshift landing table: %s", self.s_landing_table)
 
+        # the create table header of the redshift ddl is rewritten to target the landing table
+        self.redshift_ddl_header = (
+            f"CREATE TABLE IF NOT EXISTS {self.r_src_schema}.{self.r_src_table}"
+        )
+        self.snowflake_ddl_header = f"CREATE OR REPLACE TABLE {self.s_landing_table}"
+
     def get_ddl_for_snowlake(self):
         res = redshift.exec_sql(
-            f"""select * from table_definition where schemaname = '{self.r_src_schema}'
-            and tablename = '{self.r_src_table}';"""
+            DDL_SQL.format(schema=self.r_src_schema, table=self.r_src_table)
         )
 
-        result = res.fetchall()
-        ddl = [row[2] for row in result]
-        res.close()
+        def fetched_lines():
+            # batches are released as soon as their lines have been consumed
+            while True:
+                rows = res.fetchmany(DDL_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[2]
+
+        def ddl_lines():
+            for line in fetched_lines():
+                # Parsed ddl is coupled with alter and drop statements which aren't needed
+                if line.startswith(("ALTER TABLE", "--DROP TABLE")):
+                    continue
+                if line.startswith("CREATE TABLE IF NOT EXISTS"):
+                    # the header is standardized on its own so it can be rewritten here
+                    line = standardize_columns(
+                        line, self.remove_quotes_from_create_table
+                    )
+                    if line.startswith(self.redshift_ddl_header):
+                        line = (
+                            self.snowflake_ddl_header
+                            + line[len(self.redshift_ddl_header) :]
+                        )
+                    yield line, False
+                else:
+                    yield line, can_remove_quotes(
+                        line, self.remove_quotes_from_create_table
+                    )
+
+        def parsed_ddl():
+            # quotes are stripped from each run of consecutive lines that allow it in one pass
+            for remove_quotes, lines in itertools.groupby(
+                ddl_lines(), key=itemgetter(1)
+            ):
+                block = "\n".join(line for line, _ in lines)
+                yield block.translate(quotes) if remove_quotes else block
 
         log.info("Starting ddl parsing...")
 
-        # Parsed ddl is coupled with alter and drop statements which aren't needed
-        parsed_ddl = [
-            standardize_columns(line, self.remove_quotes_from_create_table)
-            for line in ddl
-            if not (line.startswith("ALTER TABLE") or line.startswith("--DROP TABLE"))
-        ]
+        # rows are filtered, standardized and get their header rewritten as they are fetched
+        try:
+            snowflake_ddl = "\n".join(parsed_ddl())
+        finally:
+            res.close()
 
-        ddl = "\n".join(parsed_ddl)
-        log.info("Redshift ddl")
-        log.info(sqlparse.format(ddl, reindent=False))
+        if not snowflake_ddl.strip():
+            raise Exception(
+                f"No ddl found in table_definition for {self.r_src_schema}.{self.r_src_table}"
+            )
 
-        snowflake_ddl = ddl.replace(
-            f"CREATE TABLE IF NOT EXISTS {self.r_src_schema}.{self.r_src_table}",
-            f"CREATE OR REPLACE TABLE {self.s_landing_table}",
-        )
         log.info("-- Snowflake ddl")
-        log.info(sqlparse.format(snowflake_ddl, reindent=False))
+        log_sql(snowflake_ddl)
 
         return snowflake_ddl
 
@@ -97,52 +243,67 @@ class RedshiftToSnowflakeTransfer(object):
         )  # Neat query construct trick
         bucket = watermark.replace("'", "")
 
-        unload_sql = f"""
-        unload ($$select * from {schema}.{table}
-        where {column} <= {watermark}$$)
-        to 's3://{S3_BUCKET}/unload/snowflake_parity/nsp={schema}/{table}/{bucket}/'
-        iam_role '{IAM_ROLE}'
-        delimiter '|'
-        addquotes
-        null 'NULL'
-        escape
-        maxfilesize 100MB
-        gzip
-        cleanpath;
-        """
+        if self.unload_format == "parquet":
+            format_options = UNLOAD_PARQUET_OPTIONS
+        elif self.strict_quotes:
+            format_options = UNLOAD_CSV_OPTIONS
+        else:
+            format_options = UNLOAD_UNQUOTED_CSV_OPTIONS
+
+        unload_sql = UNLOAD_SQL.format(
+            schema=schema,
+            table=table,
+            column=column,
+            watermark=watermark,
+            s3_bucket=S3_BUCKET,
+            bucket=bucket,
+            iam_role=IAM_ROLE,
+            format_options=format_options,
+        )
 
         redshift.exec_sql(unload_sql)
 
-    def create_redshift_dest_table_in_snowflake(self):
-        snowflake_client.exec_sql(self.get_ddl_for_snowlake())
+    def create_redshift_dest_table_in_snowflake(self, snowflake_ddl=None):
+        if snowflake_ddl is None:
+            snowflake_ddl = self.get_ddl_for_snowlake()
+        snowflake_client.exec_sql(snowflake_ddl)
 
     def load_from_s3_to_snowflake_table(self):
         bucket = (
             self.watermark or "1"
         )  # This kind of bucket means it was loaded without watermark
 
-        copy_sql = fr"""
-        copy into {self.s_landing_table}
-        from
-        @{SNOWFLAKE_STAGE}/unload/snowflake_parity/nsp={self.r_src_schema}/{self.r_src_table}/{bucket}/
-        file_format = (
-        type = csv
-        field_delimiter = '|'
-        field_optionally_enclosed_by = '"'
-        escape = '\\'
-        null_if = ('NULL')
-        empty_field_as_null = False
-        );
-        """
+        if self.unload_format == "parquet":
+            format_options = COPY_PARQUET_OPTIONS
+        elif self.strict_quotes:
+            format_options = COPY_CSV_OPTIONS
+        else:
+            format_options = COPY_UNQUOTED_CSV_OPTIONS
+
+        copy_sql = COPY_SQL.format(
+            landing_table=self.s_landing_table,
+            stage=SNOWFLAKE_STAGE,
+            schema=self.r_src_schema,
+            table=self.r_src_table,
+            bucket=bucket,
+            format_options=format_options,
+        )
 
         snowflake_client.exec_sql(copy_sql)
 
     def transfer_redshift_table_to_snowflake(self):
         log.info("Starting redshift-to-snowflake transfer...")
 
-        self.unload_redshift_table_to_s3()
+        # read the ddl up front so redshift only runs one statement at a time
+        snowflake_ddl = self.get_ddl_for_snowlake()
 
-        self.create_redshift_dest_table_in_snowflake()
+        # the landing table is created in snowflake while redshift unloads to s3
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            create_table = executor.submit(
+                self.create_redshift_dest_table_in_snowflake, snowflake_ddl
+            )
+            self.unload_redshift_table_to_s3()
+            create_table.result()
 
         self.load_from_s3_to_snowflake_table()
 
@@ -1,42 +1,121 @@
+import gzip
 import json
 import logging
+import os
+import tempfile
+import uuid
 
-import sqlparse
 from faire.internal.snowflake_client import client as snowflake_client
 
+try:
+    from table_validation.sql_logging import log_sql
+except ModuleNotFoundError:
+    from sql_logging import log_sql
+
 log = logging.getLogger()
 
+TABLE_CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS {result_table} (
+COMPLETED_AT TIMESTAMP_NTZ,
+SRC_SCHEMA VARCHAR,
+SRC_TABLE VARCHAR,
+URL VARCHAR,
+RESULT VARIANT
+);
+"""
+
+INSERT_SQL = """
+{table_create_sql}
+
+INSERT INTO {result_table}
+SELECT COLUMN1 AS COMPLETED_AT, COLUMN2 AS SRC_SCHEMA,
+COLUMN3 AS SRC_TABLE, COLUMN4 AS URL, PARSE_JSON(COLUMN5) AS RESULT
+FROM VALUES ({timestamp}, {schema}, {table}, {url}, {result})
+         AS VALS;
+"""
+
+# the table stage of db.schema.table is @db.schema.%table
+LOAD_SQL = """
+{table_create_sql}
+
+PUT 'file://{file_path}' {table_stage} AUTO_COMPRESS = FALSE;
+
+COPY INTO {result_table}
+FROM {table_stage}
+FILES = ('{file_name}')
+FILE_FORMAT = (TYPE = JSON)
+MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+PURGE = TRUE;
+"""
+
+
+def quote_literal(value):
+    # backslashes and single quotes are escaped so the value round-trips as-is through
+    # a snowflake string literal
+    escaped = str(value).replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
 
 class ResultTable(object):
     def __init__(self, result_table):
         self.result_table = result_table
 
+    def get_table_create_sql(self):
+        return TABLE_CREATE_SQL.format(result_table=self.result_table)
+
     def save(self, timestamp, url, result, schema, table):
-        table_create_sql = f"""
-        CREATE TABLE IF NOT EXISTS {self.result_table} (
-        COMPLETED_AT TIMESTAMP_NTZ,
-        SRC_SCHEMA VARCHAR,
-        SRC_TABLE VARCHAR,
-        URL VARCHAR,
-        RESULT VARIANT
-        );
-        """
+        sql = INSERT_SQL.format(
+            table_create_sql=self.get_table_create_sql(),
+            result_table=self.result_table,
+            timestamp=quote_literal(timestamp),
+            schema=quote_literal(schema),
+            table=quote_literal(table),
+            url=quote_literal(url),
+            result=quote_literal(json.dumps(result)),
+        )
+
+        log_sql(sql)
 
-        # Replace single-quote with double quote to make it work for inserts
-        escaped_result = json.dumps(result).replace("'", "").replace("\\n", "")
+        snowflake_client.exec_sql_multi(sql, parse_from_redshift=False)
+
+        log.info(f"Result stored in {result}")
 
-        sql = f"""
-        {table_create_sql}
+    def save_many(self, rows):
+        """Store many results with a single PUT and COPY INTO instead of one INSERT each
 
-        INSERT INTO {self.result_table}
-        SELECT COLUMN1 AS COMPLETED_AT, COLUMN2 AS SRC_SCHEMA,
-        COLUMN3 AS SRC_TABLE, COLUMN4 AS URL, PARSE_JSON(COLUMN5) AS RESULT
-        FROM VALUES ('{timestamp}', '{schema}', '{table}', '{url}', '{escaped_result}')
-                 AS VALS;
+        Args:
+            rows: list of dicts with the same keys as the arguments of save
         """
+        if not rows:
+            return
 
-        log.info(sqlparse.format(sql))
+        *table_path, table_name = self.result_table.split(".")
+        table_stage = "@" + ".".join([*table_path, f"%{table_name}"])
+        file_name = f"results_{uuid.uuid4().hex}.ndjson.gz"
 
-        snowflake_client.exec_sql_multi(sql, parse_from_redshift=False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, file_name)
+            with gzip.open(file_path, "wt") as f:
+                for row in rows:
+                    record = {
+                        "COMPLETED_AT": row["timestamp"],
+                        "SRC_SCHEMA": row["schema"],
+                        "SRC_TABLE": row["table"],
+                        "URL": row["url"],
+                        "RESULT": row["result"],
+                    }
+                    f.write(json.dumps(record) + "\n")
 
-        log.info(f"Result stored in {result}")
+            sql = LOAD_SQL.format(
+                table_create_sql=self.get_table_create_sql(),
+                file_path=file_path,
+                table_stage=table_stage,
+                result_table=self.result_table,
+                file_name=file_name,
+            )
+
+            log_sql(sql)
+
+            snowflake_client.exec_sql_multi(sql, parse_from_redshift=False)
+
+        log.info(f"{len(rows)} results stored in {self.result_table}")
@@ -2,8 +2,44 @@ import logging
 
 from faire.internal.snowflake_client import client as snowflake_client
 
+try:
+    from table_validation.sql_identifiers import (
+        validate_copy_options,
+        validate_identifiers,
+    )
+except ModuleNotFoundError:
+    from sql_identifiers import validate_copy_options, validate_identifiers
+
 log = logging.getLogger()
 
+CREATE_SQL = """
+CREATE OR REPLACE TABLE {landing_table} (
+    {ddl}
+);
+"""
+
+COPY_SQL = """
+copy into {landing_table}
+from
+s3://{s3_bucket}/{s3_key}
+storage_integration = s3_int
+file_format = (
+    TYPE = CSV FIELD_DELIMITER = '{delimiter}'
+    FIELD_OPTIONALLY_ENCLOSED_BY = {enclosed_by}
+    )
+ON_ERROR = {on_error}
+;
+"""
+
+ROUND_SQL = """
+CREATE OR REPLACE TABLE {landing_table} as
+select
+    {round_scales}
+
+from {landing_table}
+;
+"""
+
 
 class S3ToSnowflakeTransfer(object):
 
@@ -24,8 +60,19 @@ class S3ToSnowflakeTransfer(object):
         csv_file_delimiter,
         **_,
     ):
+        validate_identifiers(
+            snowflake_dest_db=snowflake_dest_db,
+            snowflake_dest_schema=snowflake_dest_schema,
+            snowflake_dest_table=snowflake_dest_table,
+        )
         self.s3_bucket = s3_bucket.lower()
         self.s3_key = s3_key.lower()
+        validate_copy_options(
+            s3_bucket=self.s3_bucket,
+            s3_key=self.s3_key,
+            on_error=on_error,
+            field_optionally_enclosed_by=field_optionally_enclosed_by,
+        )
         self.s_dest_db = snowflake_dest_db
         self.s_dest_schema = snowflake_dest_schema
         self.s_dest_table = snowflake_dest_table
@@ -46,51 +93,46 @@ class S3ToSnowflakeTransfer(object):
         )
         log.info("snowflake landing table: %s", self.s_landing_table)
 
+    def get_create_sql(self):
+        return CREATE_SQL.format(
+            landing_table=self.s_landing_table, ddl=self.snowflake_ddl
+        )
+
+    def get_copy_sql(self):
+        return COPY_SQL.format(
+            landing_table=self.s_landing_table,
+            s3_bucket=self.s3_bucket,
+            s3_key=self.s3_key,
+            delimiter=self.csv_file_delimiter,
+            enclosed_by=self.field_optionally_enclosed_by,
+            on_error=self.on_error,
+        )
+
+    def get_round_sql(self):
+        return ROUND_SQL.format(
+            landing_table=self.s_landing_table, round_scales=self.round_scales
+        )
+
     def create_s3_dest_table_in_snowflake(self):
-        ddl = f"""
-        CREATE OR REPLACE TABLE {self.s_landing_table} (
-            {self.snowflake_ddl}
-        );
-        """
-        snowflake_client.exec_sql(ddl)
+        snowflake_client.exec_sql(self.get_create_sql())
 
     def load_from_s3_to_snowflake_table(self):
-        copy_sql = f"""
-        copy into {self.s_landing_table}
-        from
-        s3://{self.s3_bucket}/{self.s3_key}
-        storage_integration = s3_int
-        file_format = (
-            TYPE = CSV FIELD_DELIMITER = '{self.csv_file_delimiter}'
-            FIELD_OPTIONALLY_ENCLOSED_BY = {self.field_optionally_enclosed_by}
-            )
-        ON_ERROR = {self.on_error}
-        ;
-        """
-
-        snowflake_client.exec_sql(copy_sql)
+        snowflake_client.exec_sql(self.get_copy_sql())
 
     def round_snowflake_table(self):
-        round_sql = f"""
-        CREATE OR REPLACE TABLE {self.s_landing_table} as
-        select
-            {self.round_scales}
-
-        from {self.s_landing_table}
-        ;
-        """
-
-        snowflake_client.exec_sql(round_sql)
+        snowflake_client.exec_sql(self.get_round_sql())
 
     def transfer_s3_file_to_snowflake(self):
         log.info("Starting s3-to-snowflake transfer...")
 
-        self.create_s3_dest_table_in_snowflake()
-
-        self.load_from_s3_to_snowflake_table()
-
+        # create, copy and round are sent together to save round trips to snowflake
+        statements = [self.get_create_sql(), self.get_copy_sql()]
         if self.round_scales:
-            self.round_snowflake_table()
+            statements.append(self.get_round_sql())
+
+        snowflake_client.exec_sql_multi(
+            "\n".join(statements), parse_from_redshift=False
+        )
 
         log.info("s3-to-snowflake transfer complete...")
         log.info("S3 file copied to: %s", self.s_landing_table)
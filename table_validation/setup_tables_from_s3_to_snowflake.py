@@ -8,6 +8,7 @@ logging.basicConfig(
 
 import argparse
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
@@ -36,8 +37,6 @@ def run(kwargs, dry_run=False):
         on_error=kwargs["on_error"],
         csv_file_delimiter=kwargs["csv_file_delimiter"],
     )
-    if not dry_run:
-        redshift_s3_to_snowflake_transfer.transfer_s3_file_to_snowflake()
 
     # Setup validation table for Snowflake S3 file
     snowflake_s3_to_snowflake_transfer = S3ToSnowflakeTransfer(
@@ -52,8 +51,20 @@ def run(kwargs, dry_run=False):
         on_error=kwargs["on_error"],
         csv_file_delimiter=kwargs["csv_file_delimiter"],
     )
+
     if not dry_run:
-        snowflake_s3_to_snowflake_transfer.transfer_s3_file_to_snowflake()
+        # both transfers mostly wait on remote sql, so run them side by side
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(
+                    redshift_s3_to_snowflake_transfer.transfer_s3_file_to_snowflake
+                ),
+                executor.submit(
+                    snowflake_s3_to_snowflake_transfer.transfer_s3_file_to_snowflake
+                ),
+            ]
+            for future in futures:
+                future.result()
 
 
 if __name__ == "__main__":
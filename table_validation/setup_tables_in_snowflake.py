@@ -9,6 +9,7 @@ logging.basicConfig(
 
 import argparse
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
@@ -28,13 +29,21 @@ def run(kwargs, dry_run=False):
 
     # Setup validation table for Redshift
     snowflake_transfer = RedshiftToSnowflakeTransfer(**kwargs)
-    if not dry_run:
-        snowflake_transfer.transfer_redshift_table_to_snowflake()
 
     # Setup validation table for Snowflake
     snowflake_internal_transfer = SnowflakeToSnowflakeTransfer(**kwargs)
+
     if not dry_run:
-        snowflake_internal_transfer.do_transfer()
+        # both transfers mostly wait on remote sql, so run them side by side
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(
+                    snowflake_transfer.transfer_redshift_table_to_snowflake
+                ),
+                executor.submit(snowflake_internal_transfer.do_transfer),
+            ]
+            for future in futures:
+                future.result()
 
 
 if __name__ == "__main__":
@@ -63,6 +72,27 @@ if __name__ == "__main__":
 
     parser.add_argument("--watermark_column", help="watermark column")
     parser.add_argument("--high_watermark", help="high watermark value")
+    parser.add_argument(
+        "--unload_format",
+        help="file format used to unload the redshift table to s3",
+        choices=["parquet", "csv"],
+        default="parquet",
+    )
+    parser.add_argument(
+        "--no_strict_quotes",
+        help="unload csv without quoting or escaping cells, only for tables without pipes, quotes "
+        "or newlines in their values",
+        dest="strict_quotes",
+        action="store_false",
+    )
+    parser.add_argument(
+        "--insert_buckets",
+        help="copy the snowflake table with this many concurrent inserts, for large tables. "
+        "Each insert scans and hashes the whole source table, so the warehouse does this many "
+        "times the work of a single copy. At most 8 inserts run at a time",
+        default=1,
+        type=int,
+    )
 
     parser.add_argument(
         "-y", "--yaml", help="uses config.yaml instead of cli args", action="store_true"
@@ -1,10 +1,48 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-import sqlparse
 from faire.internal.snowflake_client import client as snowflake_client
 
+try:
+    from table_validation.sql_identifiers import validate_identifiers
+    from table_validation.sql_logging import log_sql
+except ModuleNotFoundError:
+    from sql_identifiers import validate_identifiers
+    from sql_logging import log_sql
+
 log = logging.getLogger()
 
+COPY_SQL = """
+CREATE OR REPLACE TABLE {landing_table} AS
+WITH VALIDATION_TABLE AS (
+    SELECT *
+    FROM {src_table}
+    WHERE {column} <= {watermark}
+)
+SELECT *
+FROM VALIDATION_TABLE;
+"""
+
+CREATE_LIKE_SQL = """
+CREATE OR REPLACE TABLE {landing_table} LIKE {src_table};
+"""
+
+# rows are split into buckets by the hash of the whole row
+BUCKET_INSERT_SQL = """
+INSERT INTO {landing_table}
+SELECT *
+FROM {src_table}
+WHERE {column} <= {watermark}
+AND MOD(ABS(HASH(*)), {buckets}) = {bucket};
+"""
+
+DROP_SQL = """
+DROP TABLE IF EXISTS {landing_table};
+"""
+
+# every bucket insert scans the whole source table, so only this many run at a time
+MAX_INSERT_WORKERS = 8
+
 
 class SnowflakeToSnowflakeTransfer(object):
     def __init__(
@@ -17,8 +55,17 @@ class SnowflakeToSnowflakeTransfer(object):
         snowflake_dest_schema,
         watermark_column=None,
         high_watermark=None,
+        insert_buckets=1,
         **_,
     ):
+        validate_identifiers(
+            snowflake_src_db=snowflake_src_db,
+            snowflake_src_schema=snowflake_src_schema,
+            snowflake_src_table=snowflake_src_table,
+            snowflake_dest_db=snowflake_dest_db,
+            snowflake_dest_schema=snowflake_dest_schema,
+            watermark_column=watermark_column,
+        )
         self.src_db = snowflake_src_db
         self.src_schema = snowflake_src_schema
         self.src_table = snowflake_src_table
@@ -26,6 +73,13 @@ class SnowflakeToSnowflakeTransfer(object):
         self.dest_schema = snowflake_dest_schema
         self.watermark_column = watermark_column
         self.watermark = high_watermark.strftime("%Y-%m-%d") if high_watermark else None
+        # large tables can be copied with this many concurrent inserts instead of one CTAS
+        self.insert_buckets = 1 if insert_buckets is None else int(insert_buckets)
+        if self.insert_buckets < 1:
+            raise Exception(
+                f"insert_buckets must be 1 for a single CTAS or at least 2 for a bucketed "
+                f"transfer, got {insert_buckets}"
+            )
 
         self.landing_table = f"{self.dest_db}.{self.dest_schema}.snowflake_{self.src_schema}_{self.src_table}"
         log.info("Snowflake landing table: %s", self.landing_table)
@@ -38,19 +92,71 @@ class SnowflakeToSnowflakeTransfer(object):
             f"'{self.watermark}'" if self.watermark else 1
         )  # Neat query construct trick
 
-        copy_sql = f"""
-        CREATE OR REPLACE TABLE {self.landing_table} AS
-        WITH VALIDATION_TABLE AS (
-            SELECT *
-            FROM {self.src_db}.{self.src_schema}.{self.src_table}
-            WHERE {column} <= {watermark}
+        if self.insert_buckets > 1:
+            self.do_bucketed_transfer(column, watermark)
+            return
+
+        copy_sql = COPY_SQL.format(
+            landing_table=self.landing_table,
+            src_table=f"{self.src_db}.{self.src_schema}.{self.src_table}",
+            column=column,
+            watermark=watermark,
         )
-        SELECT *
-        FROM VALIDATION_TABLE;
-        """
-        log.info(sqlparse.format(copy_sql))
+        log_sql(copy_sql)
 
         snowflake_client.exec_sql(copy_sql, parse_from_redshift=False)
 
         log.info("snowflake internal transfer complete...")
         log.info("Snowflake data copied to: %s", self.landing_table)
+
+    def do_bucketed_transfer(self, column, watermark):
+        src_table = f"{self.src_db}.{self.src_schema}.{self.src_table}"
+
+        create_sql = CREATE_LIKE_SQL.format(
+            landing_table=self.landing_table, src_table=src_table
+        )
+        log_sql(create_sql)
+
+        snowflake_client.exec_sql(create_sql, parse_from_redshift=False)
+
+        # each bucket is inserted by its own query so the warehouse runs them side by side
+        insert_sqls = [
+            BUCKET_INSERT_SQL.format(
+                landing_table=self.landing_table,
+                src_table=src_table,
+                column=column,
+                watermark=watermark,
+                buckets=self.insert_buckets,
+                bucket=bucket,
+            )
+            for bucket in range(self.insert_buckets)
+        ]
+        log_sql(insert_sqls[0])
+
+        max_workers = min(self.insert_buckets, MAX_INSERT_WORKERS)
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(
+                        snowflake_client.exec_sql, insert_sql, parse_from_redshift=False
+                    )
+                    for insert_sql in insert_sqls
+                ]
+                try:
+                    for future in futures:
+                        future.result()
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        except Exception:
+            # don't leave a partially loaded landing table behind
+            log.error("Bucketed insert failed, dropping %s", self.landing_table)
+            snowflake_client.exec_sql(
+                DROP_SQL.format(landing_table=self.landing_table),
+                parse_from_redshift=False,
+            )
+            raise
+
+        log.info("snowflake internal transfer complete...")
+        log.info("Snowflake data copied to: %s", self.landing_table)
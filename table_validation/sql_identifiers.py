@@ -0,0 +1,35 @@
+import re
+
+# plain unquoted identifiers, these end up formatted into generated sql which can't take bind
+# parameters for names, so anything else is rejected rather than escaped
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_$]*")
+
+# the same goes for the stage location and options of a COPY INTO
+S3_BUCKET_PATTERN = re.compile(r"[a-z0-9][a-z0-9.\-]{1,62}")
+S3_KEY_PATTERN = re.compile(r"[\w\-./=+]*")
+# snowflake only accepts the percentage form of SKIP_FILE quoted
+ON_ERROR_PATTERN = re.compile(
+    r"CONTINUE|SKIP_FILE(_[0-9]+)?|'SKIP_FILE_[0-9]+%'|ABORT_STATEMENT", re.IGNORECASE
+)
+ENCLOSED_BY_PATTERN = re.compile(r"NONE|[^'\\]", re.IGNORECASE)
+
+
+def _validate(pattern, kind, values):
+    for name, value in values.items():
+        if value is not None and not pattern.fullmatch(value):
+            raise Exception(f"{name} is not a valid {kind}: {value!r}")
+
+
+def validate_identifiers(**identifiers):
+    _validate(IDENTIFIER_PATTERN, "sql identifier", identifiers)
+
+
+def validate_copy_options(*, s3_bucket, s3_key, on_error, field_optionally_enclosed_by):
+    _validate(S3_BUCKET_PATTERN, "s3 bucket", {"s3_bucket": s3_bucket})
+    _validate(S3_KEY_PATTERN, "s3 key", {"s3_key": s3_key})
+    _validate(ON_ERROR_PATTERN, "ON_ERROR option", {"on_error": on_error})
+    _validate(
+        ENCLOSED_BY_PATTERN,
+        "FIELD_OPTIONALLY_ENCLOSED_BY option",
+        {"field_optionally_enclosed_by": field_optionally_enclosed_by},
+    )
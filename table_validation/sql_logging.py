@@ -0,0 +1,11 @@
+import logging
+
+log = logging.getLogger()
+
+
+def log_sql(sql):
+    # sqlparse is slow on wide tables, only import it and format the sql when it will be logged
+    if log.isEnabledFor(logging.INFO):
+        import sqlparse
+
+        log.info(sqlparse.format(sql))
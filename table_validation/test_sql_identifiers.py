@@ -0,0 +1,31 @@
+import pytest
+
+from table_validation.sql_identifiers import validate_copy_options
+
+
+def copy_options(**overrides):
+    options = {
+        "s3_bucket": "bucket",
+        "s3_key": "unload/table/",
+        "on_error": "ABORT_STATEMENT",
+        "field_optionally_enclosed_by": '"',
+    }
+    options.update(overrides)
+    return options
+
+
+@pytest.mark.parametrize(
+    "on_error",
+    ["CONTINUE", "skip_file", "SKIP_FILE_10", "'SKIP_FILE_10%'", "ABORT_STATEMENT"],
+)
+def test_valid_on_error(on_error):
+    validate_copy_options(**copy_options(on_error=on_error))
+
+
+@pytest.mark.parametrize(
+    "on_error",
+    ["SKIP_FILE_10%", "'SKIP_FILE_10'", "CONTINUE; drop table t"],
+)
+def test_invalid_on_error(on_error):
+    with pytest.raises(Exception, match="not a valid ON_ERROR option"):
+        validate_copy_options(**copy_options(on_error=on_error))
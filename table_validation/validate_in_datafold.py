@@ -11,21 +11,39 @@ import datetime
 import json
 import os
 import re
+from collections import defaultdict
+
+import yaml
 
 try:
     from table_validation.datafold_api import DatafoldApi, DatafoldApiError
     from table_validation.result_table import ResultTable
 except ModuleNotFoundError:
-    from datafold_api import DatafoldApi
+    from datafold_api import DatafoldApi, DatafoldApiError
     from result_table import ResultTable
 
 log = logging.getLogger()
 
+# List of dbs to support validation
+SUPPORTED_DB = ["redshift", "snowflake"]
 
-def call_datafold(kwargs):
-    api = DatafoldApi(**kwargs)
+# List of schemas to support validation
+SUPPORTED_SCHEMA = [
+    "s3_file",
+    "production",
+]
+
+# extract db, schema and table from a string like redshift_production_some_table
+DEST_TABLE_PATTERN = re.compile(
+    fr"({'|'.join(SUPPORTED_DB)})_({'|'.join(SUPPORTED_SCHEMA)})_(\w+)"
+)
+
+# keys that pick the datafold account and datasource a diff runs against
+DATAFOLD_API_KEYS = ("api_key", "datafold_datasource_id", "base_url")
 
-    url, result = api.run_diff(
+
+def get_diff_kwargs(kwargs):
+    return dict(
         table1=kwargs.get("table1"),
         table2=kwargs.get("table2"),
         query1=kwargs.get("query1"),
@@ -38,28 +56,29 @@ def call_datafold(kwargs):
         diff_tolerances_per_column=kwargs.get("diff_tolerances_per_column"),
     )
 
-    # extract the landing table from a string like demo_db.test.some_redshift_table
-    _, _, dest_table = kwargs["table1"].split(".")
 
-    # extract from a string like some_redshift_table
-    supported_db = ["redshift", "snowflake"]
+def get_schema_and_table(table1):
+    # extract the landing table from a string like demo_db.test.some_redshift_table
+    _, _, dest_table = table1.split(".")
 
-    # List of schemas to support validation
-    supported_schema = [
-        "s3_file",
-        "production",
-    ]
     try:
-        matched_groups = re.match(
-            fr"({'|'.join(supported_db)})_({'|'.join(supported_schema)})_([\w+_]+)",
-            dest_table,
-        )
+        matched_groups = DEST_TABLE_PATTERN.fullmatch(dest_table)
         db, schema, table = matched_groups.group(1, 2, 3)
     except AttributeError:
         _msg = f"Cannot recognize db or schema in {dest_table}"
         log.error(_msg)
         raise Exception(_msg)
 
+    return schema, table
+
+
+def call_datafold(kwargs):
+    api = DatafoldApi(**kwargs)
+
+    url, result = api.run_diff(**get_diff_kwargs(kwargs))
+
+    schema, table = get_schema_and_table(kwargs["table1"])
+
     result_table = ResultTable(result_table=kwargs.get("result_table"))
     result_table.save(
         timestamp=datetime.datetime.utcnow().isoformat(),
@@ -73,6 +92,57 @@ def call_datafold(kwargs):
         raise DatafoldApiError(result)
 
 
+def call_datafold_many(list_of_kwargs):
+    if not list_of_kwargs:
+        raise Exception("No validations to run, the batch is empty")
+
+    # fail on unrecognized tables before any diff is started
+    schemas_and_tables = [
+        get_schema_and_table(kwargs["table1"]) for kwargs in list_of_kwargs
+    ]
+
+    # diffs run against the datafold account and datasource of their own entry
+    indices_per_api = defaultdict(list)
+    for index, kwargs in enumerate(list_of_kwargs):
+        api_kwargs = tuple(kwargs.get(key) for key in DATAFOLD_API_KEYS)
+        indices_per_api[api_kwargs].append(index)
+
+    # a diff that raised is returned as its exception, the others are still stored
+    diffs = [None] * len(list_of_kwargs)
+    for indices in indices_per_api.values():
+        api = DatafoldApi(**list_of_kwargs[indices[0]])
+        api_diffs = api.run_diffs(
+            [get_diff_kwargs(list_of_kwargs[index]) for index in indices]
+        )
+        for index, diff in zip(indices, api_diffs):
+            diffs[index] = diff
+
+    timestamp = datetime.datetime.utcnow().isoformat()
+    rows_per_result_table = defaultdict(list)
+    errors = []
+    for kwargs, (schema, table), diff in zip(list_of_kwargs, schemas_and_tables, diffs):
+        if isinstance(diff, BaseException):
+            log.error("Diff of %s failed: %r", kwargs["table1"], diff)
+            errors.append(f"{kwargs['table1']}: {diff!r}")
+            continue
+
+        url, result = diff
+        if result.get("error"):
+            errors.append(f"{kwargs['table1']}: {result}")
+        rows_per_result_table[kwargs.get("result_table")].append(
+            dict(
+                timestamp=timestamp, url=url, result=result, schema=schema, table=table
+            )
+        )
+
+    # results are stored with a single load per result table
+    for result_table, rows in rows_per_result_table.items():
+        ResultTable(result_table=result_table).save_many(rows)
+
+    if errors:
+        raise DatafoldApiError(errors)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Call the DataFold API to validate a pair of tables, one in Redshift and one in Snowflake.",
@@ -82,16 +152,18 @@ if __name__ == "__main__":
 
     parser.add_argument(
         "table1",
+        nargs="?",
         help="fully resolved table 1 in Snowflake."
         "eg. demo_db.rafay.redshift_etl_core_products",
     )
     parser.add_argument(
         "table2",
+        nargs="?",
         help="fully resolved table 2 in Snowflake. "
         "eg. demo_db.rafay.snowflake_etl_core_products",
     )
     parser.add_argument(
-        "pks", nargs="+", help="list of primary keys to be used in datafold"
+        "pks", nargs="*", help="list of primary keys to be used in datafold"
     )
     parser.add_argument(
         "--query1",
@@ -137,8 +209,18 @@ if __name__ == "__main__":
         default="demo_db.diff.diff_runs",
     )
 
+    parser.add_argument(
+        "--batch",
+        help="yaml file with a list of validations to run concurrently, each one with the same keys "
+        "as these args. Args given on the command line are used as defaults for every validation",
+    )
+
     args = parser.parse_args()
 
+    # Args error generation
+    if not args.batch and not all((args.table1, args.table2, args.pks)):
+        raise Exception("Args table1, table2 and pks need to be explicitly defined")
+
     config = vars(args)
     log.info("Config received: %s", config)
 
@@ -150,4 +232,15 @@ if __name__ == "__main__":
         log.error(msg)
         raise RuntimeError(msg)
 
-    call_datafold(config)
+    if args.batch:
+        with open(args.batch, "r") as stream:
+            batch = yaml.safe_load(stream)
+
+        defaults = {
+            key: value
+            for key, value in config.items()
+            if key not in ("table1", "table2", "pks", "batch")
+        }
+        call_datafold_many([{**defaults, **validation} for validation in batch])
+    else:
+        call_datafold(config)